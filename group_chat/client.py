@@ -5,176 +5,361 @@ Supports version 1 (echo server) and version 2 (full group chat).
 """
 
 import argparse
+import os
+import selectors
 import socket
+import sys
 import threading
 
 from .command import (
+    CLIENT_COMMAND_LOOKUP,
     Command,
     ConnectCommand,
-    DisconnectCommand,
     LoginCommand,
     NewUserCommand,
-    PrintCommand,
     SendAllCommand,
     SendDirectCommand,
-    UserIdCommand,
     WhoCommand,
 )
 from .settings import HOST, SERVER_PORT
 
 
+# Room for a burst of chat messages, e.g. right after login, without
+# reserving the much larger buffers the kernel might autotune to.
+SOCKET_BUFFER_SIZE = 64 * 1024
+
+
+def make_socket_options(rcvbuf=SOCKET_BUFFER_SIZE, sndbuf=SOCKET_BUFFER_SIZE):
+    """Return the socket options to use with the given buffer sizes."""
+    return [
+        # Chat commands are small, so send each one right away instead of
+        # letting Nagle's algorithm hold it back waiting for more data.
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf),
+        (socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf),
+    ]
+
+
+DEFAULT_SOCKET_OPTIONS = make_socket_options()
+
+# Read as much as the server has sent in one call, rather than a few
+# bytes at a time.
+RECEIVE_SIZE = 65536
+
+# Seconds to wait for the server to accept the connection.
+CONNECT_TIMEOUT = 5.0
+
+
+def stdin_selectable() -> bool:
+    """Check whether stdin can be watched by a selector."""
+    # On Windows, select() only works on sockets; elsewhere, files and
+    # /dev/null cannot be polled. User input is read on a thread then.
+    if sys.platform == "win32":
+        return False
+    with selectors.DefaultSelector() as selector:
+        try:
+            selector.register(sys.stdin, selectors.EVENT_READ)
+        except (OSError, ValueError):
+            return False
+    return True
+
+
+HELP_TEXT = "\n".join([
+    "",
+    "Usage:",
+    "    help",
+    "        Show this help message.",
+    "    logout",
+    "        Exit the chat program.",
+    *(
+        command.help() for command in [
+            LoginCommand, NewUserCommand, SendAllCommand, SendDirectCommand, WhoCommand
+        ]
+    ),
+])
+
+
 class Client:
 
-    def __init__(self, server, port, version, debug):
+    def __init__(self, server, port, version, debug, socket_options=None):
         self.server = server
         self.port = port
         self.version = version
         self.debug = debug
+        self.socket_options = DEFAULT_SOCKET_OPTIONS if socket_options is None else socket_options
         self.socket = None
+        self.receive_buffer = bytearray()
+        # Scratch space recv_into() fills, so no new bytes object is
+        # allocated per receive.
+        self.receive_view = memoryview(bytearray(RECEIVE_SIZE))
+        self.input_buffer = bytearray()
+        self.pending_output = []
+        self.closed = threading.Event()
         self.current_user = None
-    
+        self.command_handlers = {
+            "help": self.do_help,
+            "h": self.do_help,
+            "login": self.do_login,
+            "newuser": self.do_newuser,
+            "send": self.do_send_v1 if version == 1 else self.do_send_v2,
+            "who": self.do_who,
+            "logout": self.do_logout_v1 if version == 1 else self.do_logout_v2,
+        }
+
+    @classmethod
+    def from_args(cls, args):
+        """Create a client from parsed command line arguments."""
+        socket_options = make_socket_options(args.rcvbuf, args.sndbuf)
+        return cls(args.host, args.port, args.version, args.debug, socket_options=socket_options)
+
     def main(self):
         """Start the client."""
         version_text = {1: "One", 2: "Two"}.get(self.version)
         print(f"My chat room client. Version {version_text}.")
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((self.server, self.port))
+            try:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                for level, option, value in self.socket_options:
+                    self.socket.setsockopt(level, option, value)
+                # Fail fast instead of hanging on a server that never answers,
+                # then go back to blocking mode for the chat itself.
+                self.socket.settimeout(CONNECT_TIMEOUT)
+                self.socket.connect((self.server, self.port))
+                self.socket.settimeout(None)
+            except OSError:
+                # Refused, timed out, an unknown host name (socket.gaierror)
+                # or any other failure to reach the server.
+                print("The chat client is unable to connect to the chat server.")
+                print(f"Is the server running at {self.server}, port {self.port}?")
+                return
             if self.debug:
                 print(f"Connected to chat server at {self.server} port {self.port}")
                 print(f"Running chat client version {self.version}")
-            threads = [
-                threading.Thread(target=self.input_loop, daemon=True),
-                threading.Thread(target=self.receive_messages, daemon=True),
-            ]
             ConnectCommand(self.socket, str(self.version)).request()
-            for thread in threads:
-                thread.start()
-            for thread in threads:
-                thread.join()
-        except ConnectionError:
-            print("The chat client is unable to connect to the chat server.")
-            print(f"Is the server running at {self.server}, port {self.port}?")
+            if stdin_selectable():
+                self.event_loop()
+            else:
+                # User input gets its own thread; server messages are handled
+                # on this one instead of a second thread it would only join.
+                input_thread = threading.Thread(target=self.input_loop, daemon=True)
+                input_thread.start()
+                self.receive_messages()
+                input_thread.join()
+        except OSError:
+            print("Server has disconnected. Good-bye!")
         except KeyboardInterrupt:
             pass
         finally:
-            self.disconnect()
+            if self.socket is not None:
+                self.disconnect()
 
     def disconnect(self):
         """Disconnect the client from the server."""
+        try:
+            # Shut down before closing so that a recv() blocked in the
+            # other thread returns instead of hanging.
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.socket.close()
+        self.closed.set()
+
+    def event_loop(self):
+        """Wait for user input and server messages together on this thread."""
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.socket, selectors.EVENT_READ, self.receive)
+            selector.register(sys.stdin, selectors.EVENT_READ, self.read_input)
+            while not self.closed.is_set():
+                for key, _ in selector.select():
+                    try:
+                        if not key.data():
+                            return
+                    except OSError:
+                        return
+
+    def read_input(self) -> bool:
+        """Run each complete line the user typed. Return False to stop."""
+        data = os.read(sys.stdin.fileno(), RECEIVE_SIZE)
+        if not data:
+            # Like input(), still run a last line that has no newline.
+            if self.input_buffer:
+                self.handle_command(self.input_buffer.decode(sys.stdin.encoding, errors="replace"))
+                self.input_buffer = bytearray()
+            return False
+        self.input_buffer.extend(data)
+        *lines, self.input_buffer = self.input_buffer.split(b"\n")
+        for line in lines:
+            if not self.handle_command(line.decode(sys.stdin.encoding, errors="replace")):
+                return False
+        return True
 
     def input_loop(self):
-        """Accept user commands, then validate and execute them."""
+        """Accept user commands from stdin in a thread of their own."""
         while True:
-            if self.socket.fileno() < 0:
+            if self.closed.is_set():
                 break
             try:
                 raw_command = input()
-                match raw_command.split():
-                    case ["help"] | ["h"]:
-                        self.print_all_help()
-                    case ["login", user_id, password]:
-                        command = LoginCommand(self.socket, user_id, password)
-                        if command.validate() and not self.current_user:
-                            command.request()
-                        elif self.current_user:
-                            print(f"Already logged in as '{self.current_user}'. Logout first")
-                        else:
-                            self.print_help(command)
-                    case ["newuser", user_id, password]:
-                        command = NewUserCommand(self.socket, user_id, password)
-                        if command.validate() and not self.current_user:
-                            command.request()
-                        elif self.current_user:
-                            print(f"Already logged in as '{self.current_user}'. Logout first")
-                        else:
-                            self.print_help(command)
-                    case ["send", *the_rest] if the_rest and self.version == 1:
-                        message = raw_command.split(maxsplit=1)[-1]
-                        command = SendAllCommand(self.socket, message)
-                        if command.validate() and self.current_user:
-                            command.request()
-                        elif not self.current_user:
-                            print(f"You must be logged in first to do that.")
-                        else:
-                            self.print_help(command)
-                    case ["send", "all", *the_rest] if the_rest and self.version == 2:
-                        message = raw_command.split(maxsplit=2)[-1]
-                        command = SendAllCommand(self.socket, message)
-                        if command.validate() and self.current_user:
-                            command.request()
-                        elif not self.current_user:
-                            print(f"You must be logged in first to do that.")
-                        else:
-                            self.print_help(command)
-                    case ["send", user_id, *the_rest] if the_rest and self.version == 2:
-                        message = raw_command.split(maxsplit=2)[-1]
-                        command = SendDirectCommand(self.socket, user_id, message)
-                        if command.validate() and self.current_user:
-                            command.request()
-                        elif not self.current_user:
-                            print(f"You must be logged in first to do that.")
-                        else:
-                            self.print_help(command)
-                        command = SendDirectCommand(self.socket, user_id, message)
-                    case ["send"]:
-                        if not self.current_user:
-                            print("Denied. Please login first.")
-                    case ["who"]:
-                        command = WhoCommand(self.socket)
-                        if self.current_user:
-                            command.request()
-                        else:
-                            print(f"You must be logged in first to do that.")
-                    case ["logout"]:
-                        if self.version == 1 and self.current_user:
-                            print(f"{self.current_user} left")
-                        break
-                    case _:
-                        if raw_command:
-                            print(f"Unknown command '{raw_command}'. Type help<Enter> to see chat commands")
-            except OSError:
-                print("Server has disconnected. Good-bye!")
+            except EOFError:
+                break
+            if not self.handle_command(raw_command):
                 break
         self.disconnect()
 
+    def handle_command(self, raw_command) -> bool:
+        """Validate and execute a user command. Return False to stop."""
+        words = raw_command.split(maxsplit=1)
+        handler = self.command_handlers.get(words[0]) if words else None
+        try:
+            handled = handler(words[1] if len(words) > 1 else "") if handler else None
+        except OSError:
+            print("Server has disconnected. Good-bye!")
+            return False
+        if handled is None:
+            if raw_command:
+                print(f"Unknown command '{raw_command}'. Type help<Enter> to see chat commands")
+            return True
+        return handled
+
+    # Each do_* handler gets the text after the command name. It returns
+    # True to keep going, False to stop the client, or None if the text
+    # does not fit the command.
+
+    def do_help(self, rest):
+        if rest:
+            return None
+        self.print_all_help()
+        return True
+
+    def do_login(self, rest):
+        return self.request_account(LoginCommand, rest)
+
+    def do_newuser(self, rest):
+        return self.request_account(NewUserCommand, rest)
+
+    # Version-specific handlers are picked once in __init__, so they do
+    # not need to check self.version on every command.
+
+    def do_send_v1(self, rest):
+        if not rest:
+            return self.deny_empty_send()
+        return self.send_message(SendAllCommand(self.socket, rest))
+
+    def do_send_v2(self, rest):
+        if not rest:
+            return self.deny_empty_send()
+        user_id, *message = rest.split(maxsplit=1)
+        if not message:
+            return None
+        if user_id == "all":
+            return self.send_message(SendAllCommand(self.socket, message[0]))
+        return self.send_message(SendDirectCommand(self.socket, user_id, message[0]))
+
+    def do_who(self, rest):
+        if rest:
+            return None
+        command = WhoCommand(self.socket)
+        if self.current_user:
+            command.request()
+        else:
+            print(f"You must be logged in first to do that.")
+        return True
+
+    def do_logout_v1(self, rest):
+        if not rest and self.current_user:
+            print(f"{self.current_user} left")
+        return self.do_logout_v2(rest)
+
+    def do_logout_v2(self, rest):
+        if rest:
+            return None
+        return False
+
+    def deny_empty_send(self):
+        """Handle a bare send command."""
+        if not self.current_user:
+            print("Denied. Please login first.")
+        return True
+
+    def request_account(self, command_class, rest):
+        """Send a login or newuser command, unless already logged in."""
+        args = rest.split()
+        if len(args) != 2:
+            return None
+        command = command_class(self.socket, *args)
+        if command.validate() and not self.current_user:
+            command.request()
+        elif self.current_user:
+            print(f"Already logged in as '{self.current_user}'. Logout first")
+        else:
+            self.print_help(command)
+        return True
+
+    def send_message(self, command):
+        """Send a chat message command, if logged in."""
+        if command.validate() and self.current_user:
+            command.request()
+        elif not self.current_user:
+            print(f"You must be logged in first to do that.")
+        else:
+            self.print_help(command)
+        return True
+
+    def receive(self) -> bool:
+        """Execute the commands the server sent. Return False once it disconnects."""
+        count = self.socket.recv_into(self.receive_view)
+        if not count:
+            return False
+        self.receive_buffer += self.receive_view[:count]
+        try:
+            self.execute_received()
+        finally:
+            self.flush_output()
+        return True
+
     def receive_messages(self):
         """Listen for commands from the server and execute them."""
-        receive_commands = [
-            DisconnectCommand,
-            PrintCommand,
-            UserIdCommand,
-        ]
-        receive_commands_lookup = {command.identifier: command for command in receive_commands}
         while True:
             try:
-                command_type = self.socket.recv(1).decode(Command.ENCODING)
-                if not command_type:
+                if not self.receive():
                     break
-                elif command_type not in receive_commands_lookup:
-                    raise ValueError(f"Unrecognized command_type: {command_type}")
-                command = receive_commands_lookup[command_type].from_socket(self.socket, client=self)
-                command.execute()
             except (KeyboardInterrupt, OSError):
                 break
+        self.closed.set()
+
+    def execute_received(self):
+        """Execute every complete command in the receive buffer."""
+        buffer = self.receive_buffer
+        size = len(buffer)
+        # Look these up once rather than on every command in the buffer.
+        lookup = CLIENT_COMMAND_LOOKUP.get
+        client_socket = self.socket
+        offset = 0
+        while offset < size:
+            command_class = lookup(buffer[offset])
+            if command_class is None:
+                raise ValueError(f"Unrecognized command_type: {chr(buffer[offset])}")
+            parsed = command_class.from_buffer(buffer, offset + 1, client_socket, client=self)
+            if parsed is None:
+                break
+            command, offset = parsed
+            command.execute()
+        del buffer[:offset]
 
     def print(self, message):
-        """Print a message for the client user."""
-        print(message)
+        """Print a message for the client user, once output is flushed."""
+        self.pending_output.append(message)
+
+    def flush_output(self):
+        """Write all pending messages to stdout with a single write."""
+        if self.pending_output:
+            sys.stdout.write("".join(f"{message}\n" for message in self.pending_output))
+            sys.stdout.flush()
+            self.pending_output.clear()
 
     def print_all_help(self):
         """Print help message for all commands."""
-        print()
-        print("Usage:")
-        print("    help")
-        print("        Show this help message.")
-        print("    logout")
-        print("        Exit the chat program.")
-        for command in [
-            LoginCommand, NewUserCommand, SendAllCommand, SendDirectCommand, WhoCommand
-        ]:
-            print(command.help())
+        print(HELP_TEXT)
 
     def print_help(self, command: Command):
         """Print the help message of a single command."""
@@ -193,8 +378,10 @@ if __name__ == "__main__":
     )
     parser.add_argument("--version", "-v", type=int, choices=[1, 2], default=2, help="Which version of the software")
     parser.add_argument("--host", "-H", default=HOST, help="Which host address or host name to use")
-    parser.add_argument("--port", "-p", default=SERVER_PORT, help="Which port to use")
-    parser.add_argument("--debug", "-d", action="store_true", help="Which port to use")
+    parser.add_argument("--port", "-p", type=int, default=SERVER_PORT, help="Which port to use")
+    parser.add_argument("--debug", "-d", action="store_true", help="Show debug information")
+    parser.add_argument("--rcvbuf", type=int, default=SOCKET_BUFFER_SIZE, help="Socket receive buffer size in bytes")
+    parser.add_argument("--sndbuf", type=int, default=SOCKET_BUFFER_SIZE, help="Socket send buffer size in bytes")
     args = parser.parse_args()
-    client = Client(HOST, SERVER_PORT, version=args.version, debug=args.debug)
+    client = Client.from_args(args)
     client.main()
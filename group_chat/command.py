@@ -6,12 +6,49 @@ it stores all relevant information needed to check for validity and to
 be able to execute.
 """
 
-from abc import ABC, abstractmethod
+from abc import ABCMeta, abstractmethod
 
 from .validation import validate_user_and_password
 
 
-class Command(ABC):
+# The value of each ASCII digit by byte value, and None for other bytes.
+DIGIT_VALUES = [byte - 0x30 if 0x30 <= byte <= 0x39 else None for byte in range(256)]
+
+
+def send_parts(socket, parts: list[bytes]):
+    """
+    Send several byte strings as one write.
+
+    sendmsg hands all the parts to the kernel at once, so they do not
+    have to be joined first. Platforms without it (Windows) fall back to
+    sendall, as does the rare partial send.
+    """
+    if not hasattr(socket, "sendmsg"):
+        socket.sendall(b''.join(parts))
+        return
+    sent = socket.sendmsg(parts)
+    total = sum(map(len, parts))
+    if sent < total:
+        socket.sendall(b''.join(parts)[sent:])
+
+
+class CommandMeta(ABCMeta):
+    """
+    Give each command class __slots__ for its keys.
+
+    Slots have to exist when the class is created, so they are added to
+    the class namespace here. Commands are created for every message, and
+    without a __dict__ they are smaller and quicker to read.
+    """
+
+    def __new__(mcls, name, bases, namespace, **kwargs):
+        if "__slots__" not in namespace:
+            inherited = {slot for base in bases for cls in base.__mro__ for slot in getattr(cls, "__slots__", ())}
+            namespace["__slots__"] = tuple(key for key in namespace.get("keys", []) if key not in inherited)
+        return super().__new__(mcls, name, bases, namespace, **kwargs)
+
+
+class Command(metaclass=CommandMeta):
     """
     Command base class, encapsulating basic rules of communication.
 
@@ -41,11 +78,52 @@ class Command(ABC):
 
     identifier = "_"
     keys = []
+    # Keys whose received bytes are kept in raw_values, to be forwarded
+    # without encoding them again.
+    raw_keys = ()
+
+    __slots__ = ("socket", "server", "client", "raw_values")
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # These never change for a command type, so encode them once here
+        # rather than on every send.
+        cls.identifier_bytes = cls.identifier.encode(cls.ENCODING)
+        cls.header_format = b"%%%dd" % cls.HEADER_WIDTH
+        if len(cls.keys) == 1 and "get_request_payload" not in vars(cls):
+            cls.get_request_payload = cls.make_single_key_payload_builder()
+
+    @classmethod
+    def make_single_key_payload_builder(cls):
+        """
+        Return a get_request_payload specialized for a one-key command.
+
+        Most commands sent have one field (PrintCommand above all), and
+        for them the payload is a plain concatenation of three byte
+        strings, with no lists or join needed.
+        """
+        key = cls.keys[0]
+        identifier_bytes = cls.identifier_bytes
+        header_format = cls.header_format
+        encoding = cls.ENCODING
+
+        def get_request_payload(self):
+            value = getattr(self, key)
+            if not isinstance(value, bytes):
+                value = value.encode(encoding)
+            return identifier_bytes + header_format % len(value) + value
+
+        get_request_payload.__doc__ = Command.get_request_payload.__doc__
+        return get_request_payload
 
     def __init__(self, socket, *args, server=None, client=None, **kwargs):
         self.socket = socket
         self.server = server
         self.client = client
+        # The field bytes as received, if this command came off a socket
+        # and has raw_keys. None otherwise, so commands that are only
+        # sent do not each carry an empty dict.
+        self.raw_values = None
         if not kwargs and len(args) == len(self.keys):
             for arg, key in zip(args, self.keys):
                 setattr(self, key, arg)
@@ -53,17 +131,30 @@ class Command(ABC):
             for key in self.keys:
                 setattr(self, key, kwargs[key])
 
-    @staticmethod
-    def read(socket, count):
-        """Read a certain number of bytes from a socket."""
-        chunks = []
-        total_received = 0
-        while total_received < count:
-            chunk = socket.recv(min(count - total_received, Command.MAX_MESSAGE_SIZE))
-            chunks.append(chunk)
-            total_received += len(chunk)
-        return b''.join(chunks)
-    
+    @classmethod
+    def parse_header(cls, data, start=0) -> int:
+        """
+        Parse the length header that begins at data[start].
+
+        Headers are ASCII digits padded on the left with spaces, so the
+        digits are added up directly instead of decoding to a str and
+        calling int(). Raise ValueError if the header holds anything
+        else, such as a space after a digit or no digits at all.
+        """
+        end = start + cls.HEADER_WIDTH
+        i = start
+        while i < end and data[i] == 0x20:
+            i += 1
+        if i == end:
+            raise ValueError(f"Malformed length header: {bytes(data[start:end])!r}")
+        count = 0
+        for i in range(i, end):
+            digit = DIGIT_VALUES[data[i]]
+            if digit is None:
+                raise ValueError(f"Malformed length header: {bytes(data[start:end])!r}")
+            count = count * 10 + digit
+        return count
+
     @abstractmethod
     def execute(self):
         """Execute the command."""
@@ -78,40 +169,76 @@ class Command(ABC):
         """Check if this this command is valid."""
         return True
 
-    def request(self, with_lock=False):
+    def request(self):
         """Send a command over the socket."""
-        if with_lock and self.server:
-            with self.server.locks[self.socket.fileno()]:
-                self.socket.sendall(self.get_request_payload())
+        if self.server:
+            self.server.send(self.socket, self.get_request_payload())
         else:
-            self.socket.sendall(self.get_request_payload())
+            send_parts(self.socket, self.get_request_parts())
+
+    def get_raw_value(self, key) -> bytes:
+        """Return a field's bytes, as received if possible."""
+        if self.raw_values is not None and key in self.raw_values:
+            return self.raw_values[key]
+        return getattr(self, key).encode(self.ENCODING)
+
+    def get_request_parts(self) -> list[bytes]:
+        """Represent the command as the byte strings to send, in order."""
+        values = []
+        for key in self.keys:
+            value = getattr(self, key)
+            values.append(value if isinstance(value, bytes) else value.encode(self.ENCODING))
+        headers = [self.header_format % len(byte_value) for byte_value in values]
+        return [self.identifier_bytes, *headers, *values]
 
     def get_request_payload(self):
         """Represent the command as a byte array for the socket."""
-        values = [getattr(self, key).encode(self.ENCODING) for key in self.keys]
-        headers = [
-            f"{len(byte_value):>{self.HEADER_WIDTH}}".encode(self.ENCODING) for byte_value in values
-        ]
-        return b''.join([self.identifier.encode(self.ENCODING), *headers, *values])
+        return b''.join(self.get_request_parts())
+
+    @classmethod
+    def build_payload(cls, *values: str | bytes) -> bytes:
+        """Build the payload for some field values once, to send many times."""
+        return cls(None, *values).get_request_payload()
         
     @classmethod
-    def from_socket(cls, socket, server=None, client=None):
+    def from_buffer(cls, buffer, start, socket, server=None, client=None, max_field_size=None):
         """
-        Recreate this command object from the socket.
+        Recreate this command object from bytes already received.
 
-        Presumably, the first byte (the identifier) has been read
-        already from the socket.
+        The identifier is assumed to be just before index start. Return
+        the command and the index just past its last field, or None if
+        the buffer does not yet hold the whole command. Raise ValueError
+        for a malformed header or a field longer than max_field_size, as
+        soon as the headers are in.
         """
-        header_size = len(cls.keys) * cls.HEADER_WIDTH
-        header_bytes = cls.read(socket, header_size)
+        header_end = start + len(cls.keys) * cls.HEADER_WIDTH
+        if len(buffer) < header_end:
+            return None
+        counts = [cls.parse_header(buffer, i) for i in range(start, header_end, cls.HEADER_WIDTH)]
+        if max_field_size is not None and max(counts, default=0) > max_field_size:
+            raise ValueError(f"Field longer than {max_field_size} bytes: {cls.__name__}")
+        end = header_end + sum(counts)
+        if len(buffer) < end:
+            return None
         kwargs = {}
-        for i, key in enumerate(cls.keys):
-            header = header_bytes[(i*cls.HEADER_WIDTH):(i*cls.HEADER_WIDTH + cls.HEADER_WIDTH)]
-            count = int(header.decode(cls.ENCODING))
-            value_bytes = cls.read(socket, count)
-            kwargs[key] = value_bytes.decode(cls.ENCODING)
-        return cls(socket, **kwargs, server=server, client=client)
-    
+        raw_values = {} if cls.raw_keys else None
+        offset = header_end
+        # When the buffer is a memoryview, slicing it does not copy, so
+        # fields are decoded straight out of it. Only fields that get
+        # forwarded are copied out as bytes.
+        for key, count in zip(cls.keys, counts):
+            field = buffer[offset:offset + count]
+            if key in cls.raw_keys:
+                raw_value = bytes(field)
+                raw_values[key] = raw_value
+                kwargs[key] = raw_value.decode(cls.ENCODING)
+            else:
+                kwargs[key] = str(field, cls.ENCODING)
+            offset += count
+        command = cls(socket, **kwargs, server=server, client=client)
+        command.raw_values = raw_values
+        return command, end
+
     def __repr__(self):
         values = [getattr(self, key) for key in self.keys]
         args = []
@@ -133,7 +260,7 @@ class ConnectCommand(Command):
     def execute(self):
         if int(self.version) != self.server.version:
             message = f"Server is running version {self.server.version}. Update client to correct version."
-            DisconnectCommand(self.socket, message=message, server=self.server).request(with_lock=True)
+            DisconnectCommand(self.socket, message=message, server=self.server).request()
             self.server.disconnect(self.socket)
         
     def validate(self):
@@ -169,10 +296,9 @@ class LoginCommand(Command):
             self.server.broadcast(f"{self.user_id} joins.")
             self.server.login(self.user_id, self.socket)
             self.server.print(f"{self.user_id} login")
-            UserIdCommand(self.socket, self.user_id, server=self.server).request(with_lock=True)
+            UserIdCommand(self.socket, self.user_id, server=self.server).request()
         else:
-            message = f"Denied. User name or password incorrect."
-            PrintCommand(self.socket, message, server=self.server).request(with_lock=True)
+            self.server.send(self.socket, LOGIN_DENIED_PAYLOAD)
     
     def validate(self) -> bool:
         return validate_user_and_password(self.user_id, self.password)
@@ -201,11 +327,11 @@ class NewUserCommand(Command):
     def execute(self):
         created = self.server.create_user(self.user_id, self.password)
         if created:
-            message = "New user account created. Please login."
             self.server.print("New user account created.")
+            payload = NEW_USER_CREATED_PAYLOAD
         else:
-            message = "Denied. User account already exists."
-        PrintCommand(self.socket, message, server=self.server).request(with_lock=True)
+            payload = NEW_USER_EXISTS_PAYLOAD
+        self.server.send(self.socket, payload)
     
     def validate(self) -> bool:
         return validate_user_and_password(self.user_id, self.password)
@@ -243,15 +369,22 @@ class SendAllCommand(Command):
     """
     identifier: str = "S"
     keys = ["message"]
+    raw_keys = ("message",)
 
     def execute(self):
         from_user_id = self.server.get_user_by_socket(self.socket)
-        full_message = f"{from_user_id}: {self.message}"
-        self.server.print(full_message)
-        for user_id, client_socket in self.server.current_users.items():
-            if self.server.version == 2 and from_user_id == user_id:
-                continue
-            PrintCommand(client_socket, full_message, server=self.server).request(with_lock=True)
+        self.server.print(f"{from_user_id}: {self.message}")
+        # Forward the message bytes as received rather than encoding the
+        # decoded message again.
+        prefix = f"{from_user_id}: ".encode(self.ENCODING)
+        payload = PrintCommand.build_payload(prefix + self.get_raw_value("message"))
+        # Version 2 does not echo the message back to the sender. Sending
+        # never changes current_users, so it is iterated without a copy.
+        skip_socket = self.socket if self.server.version == 2 else None
+        send = self.server.send
+        for client_socket in self.server.current_users.values():
+            if client_socket is not skip_socket:
+                send(client_socket, payload)
     
     def validate(self) -> bool:
         return len(self.message) in range(1, 257)
@@ -275,18 +408,17 @@ class SendDirectCommand(Command):
     """
     identifier = "D"
     keys = ["user_id", "message"]
+    raw_keys = ("message",)
 
     def execute(self):
         from_user_id = self.server.get_user_by_socket(self.socket)
         client_socket = self.server.current_users.get(self.user_id)
         self.server.print(f"{from_user_id} (to {self.user_id}): {self.message}")
         if client_socket:
-            message = f"{from_user_id}= {self.message}"
-            to_socket = client_socket
+            message = f"{from_user_id}= ".encode(self.ENCODING) + self.get_raw_value("message")
+            PrintCommand(client_socket, message, server=self.server).request()
         else:
-            message = "That user is not logged in."
-            to_socket = self.socket
-        PrintCommand(to_socket, message, server=self.server).request(with_lock=True)
+            self.server.send(self.socket, USER_NOT_LOGGED_IN_PAYLOAD)
 
     def validate(self) -> bool:
         return len(self.message) in range(1, 257) and len(self.user_id) in range(3, 33)
@@ -325,7 +457,7 @@ class WhoCommand(Command):
     def execute(self):
         connected_users = self.server.get_all_connected_users()
         connected_users_formatted = ", ".join(connected_users)
-        PrintCommand(self.socket, connected_users_formatted, server=self.server).request(with_lock=True)
+        PrintCommand(self.socket, connected_users_formatted, server=self.server).request()
 
     
     @staticmethod
@@ -337,6 +469,13 @@ class WhoCommand(Command):
         )
 
 
+# Replies that never change are encoded once, when the module is loaded.
+LOGIN_DENIED_PAYLOAD = PrintCommand.build_payload("Denied. User name or password incorrect.")
+NEW_USER_CREATED_PAYLOAD = PrintCommand.build_payload("New user account created. Please login.")
+NEW_USER_EXISTS_PAYLOAD = PrintCommand.build_payload("Denied. User account already exists.")
+USER_NOT_LOGGED_IN_PAYLOAD = PrintCommand.build_payload("That user is not logged in.")
+
+
 ALL_CLIENT_TO_SERVER_COMMANDS = [
     ConnectCommand,
     LoginCommand,
@@ -347,4 +486,15 @@ ALL_CLIENT_TO_SERVER_COMMANDS = [
 ]
 
 
-COMMAND_LOOKUP = {command.identifier: command for command in ALL_CLIENT_TO_SERVER_COMMANDS}
+ALL_SERVER_TO_CLIENT_COMMANDS = [
+    DisconnectCommand,
+    PrintCommand,
+    UserIdCommand,
+]
+
+
+# Both lookups are keyed by the identifier's byte value, so a received
+# byte can be looked up without decoding it first. Identifiers are single
+# ASCII characters.
+COMMAND_LOOKUP = {ord(command.identifier): command for command in ALL_CLIENT_TO_SERVER_COMMANDS}
+CLIENT_COMMAND_LOOKUP = {ord(command.identifier): command for command in ALL_SERVER_TO_CLIENT_COMMANDS}
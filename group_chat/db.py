@@ -1,43 +1,57 @@
 """A database for user IDs and passwords."""
 
+import os
 from pathlib import Path
 
 
 FILE_NAME = "users.txt"
 ENCODING = "utf-8"
+DEFAULT_PATH = Path(__file__).parent / Path(FILE_NAME)
 
 
-def user_exists(user_id: str) -> bool:
-    """Check if the given user ID exists in the DB."""
-    path = Path(__file__).parent / Path(FILE_NAME)
+def load_users(path=DEFAULT_PATH) -> dict[str, str]:
+    """Read every user ID and password in the DB into a dict."""
+    path = Path(path)
+    users = {}
     if not path.exists():
-        return False
+        return users
     for line in path.read_text(encoding=ENCODING).splitlines():
         split = line.split()
-        if len(split) == 2 and split[0] == user_id:
-            return True
-    return False
-
-
-def user_and_password_exists(user_id: str, password: str) -> bool:
-    """Check if the given user ID and password exist in the DB."""
-    path = Path(__file__).parent / Path(FILE_NAME)
-    if not path.exists():
-        return False
-    for line in path.read_text(encoding=ENCODING).splitlines():
-        split = line.split()
-        if len(split) == 2 and split[0] == user_id and split[1] == password:
-            return True
-    return False
-
-
-def insert_new_user_and_password(user_id: str, password: str) -> bool:
-    """Add a new user ID and password to the DB."""
-    path = Path(__file__).parent / Path(FILE_NAME)
-    if user_exists(user_id):
-        return False
-    record = f"{user_id} {password}\n"
-    with path.open("a", encoding=ENCODING) as f:
-        f.write(record)
-    return True
-        
\ No newline at end of file
+        if len(split) == 2:
+            users.setdefault(split[0], split[1])
+    return users
+
+
+class UserDB:
+    """
+    The user DB, held in memory and kept open for appending.
+
+    New users are added with one write to a file descriptor opened with
+    O_APPEND, so there is no open and close per user. With fsync=True,
+    every new user is also flushed to disk before returning.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self.users = load_users(path)
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        self.fd = os.open(path, flags, 0o600)
+
+    def get_password(self, user_id: str) -> str | None:
+        """Return the password for a user ID, or None if there is no such user."""
+        return self.users.get(user_id)
+
+    def add_user(self, user_id: str, password: str) -> bool:
+        """Add a new user ID and password, unless the user ID is taken."""
+        if user_id in self.users:
+            return False
+        os.write(self.fd, f"{user_id} {password}\n".encode(ENCODING))
+        if self.fsync:
+            os.fsync(self.fd)
+        self.users[user_id] = password
+        return True
+
+    def close(self):
+        """Close the DB file."""
+        os.close(self.fd)
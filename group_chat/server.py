@@ -5,74 +5,185 @@ Supports version 1 (echo server) and version 2 (full group chat).
 """
 
 import argparse
+from bisect import bisect_left, insort
+from collections import deque
+from itertools import islice
+import selectors
 import socket
-import threading
-from collections import defaultdict
+import traceback
 
-from .db import insert_new_user_and_password, user_and_password_exists
+from .db import UserDB
 from .command import COMMAND_LOOKUP, Command, DisconnectCommand, PrintCommand
 from .settings import HOST, SERVER_PORT, MAX_CONNECTIONS
 
 
+# The largest frame a client may send: a command with two fields, each
+# at most MAX_MESSAGE_SIZE bytes. Clients sending more are disconnected.
+MAX_FRAME_SIZE = 1 + 2 * (Command.HEADER_WIDTH + Command.MAX_MESSAGE_SIZE)
+# Each client's receive buffer holds at least one frame of the largest
+# size. Only part of a frame is left in it once the complete commands are
+# dropped, so there is always room to receive the rest.
+RECEIVE_BUFFER_SIZE = max(4096, MAX_FRAME_SIZE)
+
+# Chat messages are small and interactive, so don't let Nagle's
+# algorithm hold them back, and give each client room to burst.
+CLIENT_SOCKET_BUFFER_SIZE = 256 * 1024
+CLIENT_SOCKET_OPTIONS = [
+    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+    (socket.SOL_SOCKET, socket.SO_SNDBUF, CLIENT_SOCKET_BUFFER_SIZE),
+    (socket.SOL_SOCKET, socket.SO_RCVBUF, CLIENT_SOCKET_BUFFER_SIZE),
+]
+# At most this many queued payloads are gathered into one sendmsg call,
+# well under the usual limit of 1024.
+SEND_BATCH_SIZE = 256
+# A client still queued more than this many bytes once its queue has
+# been flushed as far as the kernel takes is not keeping up. It is
+# disconnected, so it cannot make the server buffer without end.
+MAX_SEND_QUEUE_SIZE = 1024 * 1024
+
+# Sent to connections turned away; it never changes, so encode it once.
+SERVER_FULL_PAYLOAD = DisconnectCommand.build_payload("Server cannot accept new connections. Try later.")
+
+
+class ReceiveBuffer:
+    """A client's preallocated receive buffer, filled up to end."""
+
+    def __init__(self, size=RECEIVE_BUFFER_SIZE):
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        self.end = 0
+
+    def free_view(self) -> memoryview:
+        """Return the unfilled part of the buffer."""
+        return self.view[self.end:]
+
+    def compact(self, offset):
+        """Drop the bytes before offset by moving the rest to the front."""
+        remaining = self.end - offset
+        if offset and remaining:
+            self.data[:remaining] = self.data[offset:self.end]
+        self.end = remaining
+
+
 class Server:
 
-    def __init__(self, host, port, version, max_connections, debug):
+    def __init__(self, host, port, version, max_connections, debug, fsync=False):
         self.host = host
         self.port = port
         self.version = version
         self.max_connections = max_connections
         self.debug = debug
-        self.connections = []
+        self.connections = set()
         self.current_users = {}
-        self.locks = defaultdict(threading.Semaphore)
+        self.socket_to_user = {}
+        # (lowercase user ID, user ID) for each logged in user, kept in
+        # order so "who" does not have to sort.
+        self.sorted_users = []
+        # The user IDs from sorted_users, rebuilt only after it changes.
+        self.connected_users = None
+        # Payloads not yet taken by the kernel, and their total size in
+        # bytes, by socket fileno.
+        self.send_queues = {}
+        self.send_queue_sizes = {}
+        # Sockets given payloads during this pass of the event loop. They
+        # are flushed together at the end of it.
+        self.unflushed = []
+        # Sockets whose queue went over MAX_SEND_QUEUE_SIZE during this
+        # pass. They are checked again after flushing at the end of it,
+        # not in the middle of a broadcast.
+        self.overflowed = []
+        self.db = UserDB(fsync=fsync)
+        self.selector = selectors.DefaultSelector()
         self.server_socket = None
 
     def get_user_by_socket(self, client_socket: socket.socket) -> str | None:
         """Return the user ID for a given socket or None if not found."""
-        for user_id, current_socket in self.current_users.items():
-            if current_socket is client_socket:
-                return user_id
-        return None
+        return self.socket_to_user.get(client_socket.fileno())
 
     def accept_connections(self):
         """Start to run the server by accepting connections."""
         version_text = {1: "One", 2: "Two"}.get(self.version)
         print(f"My chat room server. Version {version_text}.")
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Allow a restarted server to bind while old connections linger.
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen()
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
         if self.debug:
             print(f"Chat server running on {self.host}, port {self.port}")
+        # One thread serves every client: wait until some sockets are
+        # ready, then handle each of them without blocking on the others.
         while True:
-            try:    
-                client_socket, client_address = self.server_socket.accept()
-                if self.debug:
-                    print(f"Accepted connection from {client_address}")
-                if self.version == 2 and len(self.connections) < self.max_connections or self.version == 1:
-                    self.connections.append(client_socket)
-                    threading.Thread(target=self.handle_client, args=[client_socket]).start()
-                else:
-                    message = "Server cannot accept new connections. Try later."
-                    DisconnectCommand(client_socket, message, server=self).request(with_lock=True)
-                    self.disconnect(client_socket)
+            try:
+                for key, events in self.selector.select():
+                    if key.fileobj is self.server_socket:
+                        self.accept()
+                        continue
+                    if events & selectors.EVENT_WRITE:
+                        self.flush(key.fileobj)
+                    if events & selectors.EVENT_READ and key.fileobj.fileno() >= 0:
+                        self.handle_client(key.fileobj, key.data)
+                self.flush_unflushed()
             except KeyboardInterrupt:
                 break
         print("Shutting down server")
+        self.selector.close()
         self.server_socket.close()
         self.disconnect_all()
+        self.db.close()
+
+    def accept(self):
+        """Accept a new connection, or turn it away if the server is full."""
+        try:
+            client_socket, client_address = self.server_socket.accept()
+        except OSError as error:
+            # E.g. out of file descriptors, or the client gave up already.
+            self.print(f"Could not accept a connection: {error}")
+            return
+        if self.debug:
+            print(f"Accepted connection from {client_address}")
+        try:
+            for level, option, value in CLIENT_SOCKET_OPTIONS:
+                client_socket.setsockopt(level, option, value)
+        except OSError as error:
+            self.print(f"Could not set up the connection from {client_address}: {error}")
+            client_socket.close()
+            return
+        if self.version == 2 and len(self.connections) < self.max_connections or self.version == 1:
+            self.connections.add(client_socket)
+            client_socket.setblocking(False)
+            self.send_queues[client_socket.fileno()] = deque()
+            self.send_queue_sizes[client_socket.fileno()] = 0
+            # The registered data is the client's receive buffer.
+            self.selector.register(client_socket, selectors.EVENT_READ, ReceiveBuffer())
+        else:
+            self.send(client_socket, SERVER_FULL_PAYLOAD)
+            self.disconnect(client_socket)
 
     def disconnect(self, client_socket):
         """Disconnect a client socket."""
         if client_socket.fileno() < 0:
             return
         if self.debug:
-            print(f"Client disconnected: {client_socket.getpeername()}")
+            print(f"Client disconnected: {self.get_peer_name(client_socket)}")
         if client_socket in self.connections:
             self.connections.remove(client_socket)
-        username_to_remove = self.get_user_by_socket(client_socket)
+            self.selector.unregister(client_socket)
+        queue = self.send_queues.pop(client_socket.fileno(), None)
+        self.send_queue_sizes.pop(client_socket.fileno(), None)
+        if queue:
+            # Last chance for anything still queued, such as a
+            # DisconnectCommand explaining why.
+            try:
+                client_socket.send(b''.join(queue))
+            except OSError:
+                pass
+        username_to_remove = self.socket_to_user.pop(client_socket.fileno(), None)
         self.current_users.pop(username_to_remove, None)
         client_socket.close()
         if username_to_remove:
+            self.remove_sorted_user(username_to_remove)
             self.print(f"{username_to_remove} logout")
             self.broadcast(f"{username_to_remove} left")
     
@@ -80,41 +191,85 @@ class Server:
         """Disconnect all sockets in preparation for shutting down."""
         for client_socket in self.connections:
             if self.debug:
-                print(f"Client disconnected: {client_socket.getpeername()}")
+                print(f"Client disconnected: {self.get_peer_name(client_socket)}")
             client_socket.close()
 
-    def handle_client(self, client_socket):
-        """Handle a client's messages and react."""
-        while True:
+    def handle_client(self, client_socket, receive_buffer: ReceiveBuffer):
+        """Read what a client has sent and execute every complete command."""
+        try:
             try:
-                command_type = client_socket.recv(1).decode(Command.ENCODING)
-                if not command_type:
+                count = client_socket.recv_into(receive_buffer.free_view())
+            except BlockingIOError:
+                return
+            if not count:
+                self.disconnect(client_socket)
+                return
+            receive_buffer.end += count
+            buffer = receive_buffer.view[:receive_buffer.end]
+            offset = 0
+            while offset < len(buffer):
+                command_class = COMMAND_LOOKUP.get(buffer[offset])
+                if command_class is None:
+                    raise ValueError(f"Unrecognized command_type: {buffer[offset]:#x}")
+                parsed = command_class.from_buffer(
+                    buffer, offset + 1, client_socket, server=self, max_field_size=Command.MAX_MESSAGE_SIZE
+                )
+                if parsed is None:
                     break
-                elif command_type not in COMMAND_LOOKUP:
-                    raise ValueError(f"Unrecognized command_type: {command_type}")
-                command = COMMAND_LOOKUP[command_type].from_socket(client_socket, server=self)
+                command, offset = parsed
                 if self.debug:
-                    print(f"Received from {client_socket.getpeername()}: {command!r}")
+                    print(f"Received from {self.get_peer_name(client_socket)}: {command!r}")
                 command.execute()
-            except (KeyboardInterrupt, OSError):
-                break
-        self.disconnect(client_socket)
+                if client_socket.fileno() < 0:
+                    # The command disconnected this client.
+                    return
+            receive_buffer.compact(offset)
+        except (OSError, ValueError):
+            self.disconnect(client_socket)
+        except Exception:
+            # Every client shares this thread, so a bug hit by one
+            # client's command must only cost that client its connection.
+            traceback.print_exc()
+            self.disconnect(client_socket)
     
     def authenticate(self, user_id: str, password: str) -> bool:
         """Check if the given user ID and password exist in the DB."""
-        return user_and_password_exists(user_id, password)
+        return self.db.get_password(user_id) == password
     
     def login(self, user_id: str, client_socket: socket.socket):
         """Associate the given user ID with the given client socket."""
+        # Keep both mappings one-to-one if the user or the socket was
+        # already logged in.
+        previous_socket = self.current_users.get(user_id)
+        if previous_socket is not None:
+            self.socket_to_user.pop(previous_socket.fileno(), None)
+        else:
+            insort(self.sorted_users, (user_id.lower(), user_id))
+            self.connected_users = None
+        previous_user_id = self.socket_to_user.get(client_socket.fileno())
+        if previous_user_id is not None:
+            self.current_users.pop(previous_user_id, None)
+            self.remove_sorted_user(previous_user_id)
         self.current_users[user_id] = client_socket
+        self.socket_to_user[client_socket.fileno()] = user_id
 
     def create_user(self, user_id: str, password: str) -> bool:
         """Create a new user in the DB."""
-        return insert_new_user_and_password(user_id, password)
+        return self.db.add_user(user_id, password)
     
+    def remove_sorted_user(self, user_id: str):
+        """Remove a user ID from the sorted list of logged in users."""
+        entry = (user_id.lower(), user_id)
+        index = bisect_left(self.sorted_users, entry)
+        if index < len(self.sorted_users) and self.sorted_users[index] == entry:
+            del self.sorted_users[index]
+            self.connected_users = None
+
     def get_all_connected_users(self) -> list[str]:
-        """Return a list of all connected users IDs."""
-        return sorted(self.current_users, key=str.lower)
+        """Return a list of all connected users IDs. It is shared, so don't modify it."""
+        if self.connected_users is None:
+            self.connected_users = [user_id for _, user_id in self.sorted_users]
+        return self.connected_users
     
     def is_user_connected(self, user_id) -> bool:
         """Check if the given user ID is currently connected."""
@@ -122,8 +277,93 @@ class Server:
     
     def broadcast(self, message: str):
         """Send a message to all connected users."""
-        for socket in self.current_users.values():
-            PrintCommand(socket, message, server=self).request(with_lock=True)
+        payload = PrintCommand.build_payload(message)
+        for client_socket in self.current_users.values():
+            self.send(client_socket, payload)
+
+    def send(self, client_socket: socket.socket, payload: bytes):
+        """Send an already encoded payload to one client without blocking."""
+        queue = self.send_queues.get(client_socket.fileno())
+        if queue is None:
+            # Not served by the event loop, e.g. a connection being
+            # turned away, so a blocking send is fine.
+            try:
+                client_socket.sendall(payload)
+            except OSError:
+                pass
+            return
+        if not queue:
+            self.unflushed.append(client_socket)
+        queue.append(payload)
+        fileno = client_socket.fileno()
+        size = self.send_queue_sizes[fileno] + len(payload)
+        self.send_queue_sizes[fileno] = size
+        if size > MAX_SEND_QUEUE_SIZE >= size - len(payload):
+            self.overflowed.append(client_socket)
+
+    def flush_unflushed(self):
+        """Flush every socket given payloads during this pass of the event loop."""
+        # Flushing or disconnecting a client broadcasts that it left, which
+        # queues more; keep going until nothing new is queued.
+        while self.unflushed or self.overflowed:
+            for client_socket in self.unflushed:
+                self.flush(client_socket)
+            self.unflushed.clear()
+            # Only what is left after a flush counts against the limit.
+            overflowed, self.overflowed = self.overflowed, []
+            for client_socket in overflowed:
+                self.flush(client_socket)
+                if self.send_queue_sizes.get(client_socket.fileno(), 0) > MAX_SEND_QUEUE_SIZE:
+                    self.print(f"Disconnecting {self.get_peer_name(client_socket)}: too much unsent data")
+                    self.disconnect(client_socket)
+
+    def flush(self, client_socket: socket.socket):
+        """Send as much of a client's queued payloads as it will take."""
+        queue = self.send_queues.get(client_socket.fileno())
+        if not queue:
+            return
+        try:
+            while queue:
+                # Gather the queued payloads into one system call.
+                batch = list(islice(queue, SEND_BATCH_SIZE))
+                if hasattr(client_socket, "sendmsg"):
+                    sent = client_socket.sendmsg(batch)
+                else:
+                    sent = client_socket.send(b''.join(batch))
+                self.send_queue_sizes[client_socket.fileno()] -= sent
+                done = 0
+                while done < len(batch) and sent >= len(batch[done]):
+                    sent -= len(batch[done])
+                    done += 1
+                for _ in range(done):
+                    queue.popleft()
+                if done < len(batch):
+                    # The kernel's buffer is full; keep the rest for later.
+                    queue[0] = queue[0][sent:]
+                    break
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.disconnect(client_socket)
+            return
+        self.watch_writable(client_socket, bool(queue))
+
+    def watch_writable(self, client_socket: socket.socket, writable: bool):
+        """Choose whether the event loop waits for the socket to be writable."""
+        events = selectors.EVENT_READ
+        if writable:
+            events |= selectors.EVENT_WRITE
+        key = self.selector.get_key(client_socket)
+        if key.events != events:
+            self.selector.modify(client_socket, events, key.data)
+
+    @staticmethod
+    def get_peer_name(client_socket: socket.socket):
+        """Return the client's address, if it is still connected."""
+        try:
+            return client_socket.getpeername()
+        except OSError:
+            return "(no longer connected)"
 
     def print(self, message):
         """Print a message for server logs."""
@@ -137,10 +377,11 @@ if __name__ == "__main__":
     )
     parser.add_argument("--version", "-v", type=int, choices=[1, 2], default=2, help="Which version of the software")
     parser.add_argument("--host", "-H", default=HOST, help="Which host address or host name to use")
-    parser.add_argument("--port", "-p", default=SERVER_PORT, help="Which port to use")
+    parser.add_argument("--port", "-p", type=int, default=SERVER_PORT, help="Which port to use")
     parser.add_argument("--max-connections", "-m", default=MAX_CONNECTIONS, type=int, help="Only applies to version 2")
     parser.add_argument("--debug", "-d", action="store_true", help="Show debug information")
+    parser.add_argument("--fsync", action="store_true", help="Flush each new user to disk before replying")
     args = parser.parse_args()
     max_connections = None if args.version == 1 else args.max_connections
-    server = Server(args.host, args.port, args.version, max_connections, args.debug)
+    server = Server(args.host, args.port, args.version, max_connections, args.debug, args.fsync)
     server.accept_connections()
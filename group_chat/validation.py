@@ -1,14 +1,17 @@
 """Validations for commands."""
 
+import re
+
 USER_ID_MIN_LEN = 3
 USER_ID_MAX_LEN = 32
 PASSWORD_MIN_LEN = 4
 PASSWORD_MAX_LEN = 8
 
+# Both check the length and that there is no whitespace in one pass.
+USER_ID_PATTERN = re.compile(rf"\S{{{USER_ID_MIN_LEN},{USER_ID_MAX_LEN}}}")
+PASSWORD_PATTERN = re.compile(rf"\S{{{PASSWORD_MIN_LEN},{PASSWORD_MAX_LEN}}}")
+
 
 def validate_user_and_password(user_id: str, password: str) -> bool:
     """Check if user and password meet validation requirements."""
-    good_user_id_len = len(user_id) in range(USER_ID_MIN_LEN, USER_ID_MAX_LEN + 1)
-    good_password_len = len(password) in range(PASSWORD_MIN_LEN, PASSWORD_MAX_LEN + 1)
-    no_spaces = [item.split()[0] == item for item in (user_id, password)]
-    return good_user_id_len and good_password_len and no_spaces
+    return bool(USER_ID_PATTERN.fullmatch(user_id) and PASSWORD_PATTERN.fullmatch(password))